@@ -54,13 +54,16 @@ class Person(RandomWalker):
         """start everyone off with a random amount in their wallet from 1 to a
            user settable rich threshold amount"""
         self.wallet = random.randint(1, rich_threshold + 1)
-        # savings minus loans, see balance_books() below
-        self.wealth = 0
         # person to trade with, see do_business() below
         self.customer = 0
         # person's bank, set at __init__, all people have the same bank in this model
         self.bank = bank
 
+    # savings minus loans, worked out when asked for rather than every step
+    @property
+    def wealth(self):
+        return self.savings - self.loans
+
     def do_business(self):
         """check if person has any savings, any money in wallet, or if the
            bank can loan them any money"""
@@ -133,8 +136,6 @@ class Person(RandomWalker):
                 # pay off part of my loans with my savings
                 self.withdraw_from_savings(self.savings)
                 self.repay_a_loan(self.wallet)
-        # calculate my wealth
-        self.wealth = (self.savings - self.loans)
 
     # part of balance_books()
     def deposit_to_savings(self, amount):
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # Numba is optional, aggregate() falls back to plain NumPy reductions
+    njit = None
+    prange = range
+
+"""
+Numerical kernels used by the model every step.
+
+All Numba kernels are compiled with cache=True, so the compiled code is kept
+in __pycache__ and reused by later processes (e.g. the parameter sweep
+workers in batch_run.py) instead of being recompiled by each one.
+"""
+
+
+# populations at least this large are aggregated with the multi-threaded kernel;
+# below it the cost of starting the threads outweighs the loop itself
+PARALLEL_THRESHOLD = 10_000
+
+
+def _aggregate_loop(s, w, l, rt):
+    """
+    Fold the savings, wallet and loans arrays into the model statistics.
+
+    Returns (rich, poor, mid, total savings, total wallets, total loans) in a
+    single loop, without the temporary arrays NumPy comparisons allocate.
+    The rich/poor/mid tests are added as 0 or 1 rather than branched on, so
+    people near the thresholds don't cause branch mispredictions.
+    Only meant to run compiled by Numba, see aggregate below.
+    """
+    rich = poor = mid = 0
+    ts = tw = tl = 0.0
+    for i in range(s.size):
+        si = s[i]
+        wi = w[i]
+        li = l[i]
+        ts += si
+        tw += wi
+        tl += li
+        rich += np.int64(si > rt)
+        poor += np.int64(li > 10)
+        mid += np.int64((li < 10) & (si < rt))
+    return rich, poor, mid, ts, tw, tl
+
+
+def _aggregate_loop_parallel(s, w, l, rt):
+    """
+    Multi-threaded version of _aggregate_loop: every update is a sum, so the
+    loop runs as a prange reduction.
+
+    Kept as a separate function rather than compiling _aggregate_loop twice,
+    because Numba's on-disk cache is keyed by function and signature, not by
+    the parallel flag; sharing one function would let the serial and parallel
+    kernels load each other's cached code.
+    """
+    rich = poor = mid = 0
+    ts = tw = tl = 0.0
+    for i in prange(s.size):
+        si = s[i]
+        wi = w[i]
+        li = l[i]
+        ts += si
+        tw += wi
+        tl += li
+        rich += np.int64(si > rt)
+        poor += np.int64(li > 10)
+        mid += np.int64((li < 10) & (si < rt))
+    return rich, poor, mid, ts, tw, tl
+
+
+def _aggregate_numpy(s, w, l, rt):
+    # same result as _aggregate_loop, using whole-array reductions so there is
+    # no per-element Python work when the loop can't be compiled
+    return (np.count_nonzero(s > rt),
+            np.count_nonzero(l > 10),
+            np.count_nonzero((l < 10) & (s < rt)),
+            s.sum(), w.sum(), l.sum())
+
+
+if njit is not None:
+    _aggregate_serial = njit(cache=True, fastmath=True)(_aggregate_loop)
+    _aggregate_parallel = njit(cache=True, fastmath=True, parallel=True)(_aggregate_loop_parallel)
+
+
+def aggregate(s, w, l, rt):
+    """
+    aggregate(savings, wallets, loans, rich_threshold) -> (rich, poor, mid,
+    total savings, total wallets, total loans)
+
+    Uses the compiled loop when Numba is installed, multi-threaded from
+    PARALLEL_THRESHOLD people up, and the NumPy version otherwise.
+    """
+    if njit is None:
+        return _aggregate_numpy(s, w, l, rt)
+    if s.size >= PARALLEL_THRESHOLD:
+        return _aggregate_parallel(s, w, l, rt)
+    return _aggregate_serial(s, w, l, rt)
+
+
+def warmup(n=1):
+    """
+    Compile the kernel aggregate() selects for a population of n people.
+
+    With cache=True the compiled code is written to __pycache__ (the serial
+    and parallel kernels have separate cache entries), so calling this before
+    starting worker processes means the workers load the cached machine code
+    instead of each paying for the JIT. Only that one kernel is touched:
+    calling the parallel kernel starts Numba's thread pool, which is wasted
+    for populations below PARALLEL_THRESHOLD.
+    """
+    if njit is None:
+        return
+    a = np.zeros(1, np.float64)
+    if n >= PARALLEL_THRESHOLD:
+        _aggregate_parallel(a, a, a, 0.0)
+    else:
+        _aggregate_serial(a, a, a, 0.0)
@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 
 from bank_reserves.agents import Bank, Person
+from bank_reserves.kernels import aggregate
+from bank_reserves.recorder import StepRecorder
+from collections import namedtuple
 from mesa import Model
 from mesa.space import MultiGrid
-from mesa.datacollection import DataCollector
 from mesa.time import RandomActivation
 import numpy as np
-import random
+import shutil
 
 """
 The following code was adapted from the Bank Reserves model included in Netlogo
@@ -26,70 +28,54 @@ For details see batch_run.py in the same directory as run.py.
 """
 
 
-# Start of DataCollector functions
-def get_num_rich_agents(model):
-    # list of rich agents
-    rich_agents = [a for a in model.schedule.agents if a.savings > model.rich_threshold]
-    # return number of rich agents
-    return len(rich_agents)
+# model statistics recorded every step, in the order of MODEL_COLUMNS below
+Stats = namedtuple("Stats", ["rich", "poor", "mid", "savings", "wallets", "money", "loans"])
 
+# (name, dtype) of each recorded column
+MODEL_COLUMNS = [("Rich", np.int64),
+                 ("Poor", np.int64),
+                 ("Middle Class", np.int64),
+                 ("Savings", np.float64),
+                 ("Wallets", np.float64),
+                 ("Money", np.float64),
+                 ("Loans", np.float64)]
 
-def get_num_poor_agents(model):
-    # list of poor agents
-    poor_agents = [a for a in model.schedule.agents if a.loans > 10]
-    # return number of poor agents
-    return len(poor_agents)
 
+# model defaults, shared with batch_run.py and server.py
+GRID_HEIGHT = 20
+GRID_WIDTH = 20
+INIT_PEOPLE_DEFAULT = 2
+RICH_THRESHOLD_DEFAULT = 10
+RESERVE_PERCENT_DEFAULT = 50
+RUN_TIME_DEFAULT = 1000
+# record statistics every COLLECT_EVERY steps
+COLLECT_EVERY_DEFAULT = 10
 
-def get_num_mid_agents(model):
-    # list of middle class agents
-    mid_agents = [a for a in model.schedule.agents if
-                  a.loans < 10 and a.savings < model.rich_threshold]
-    # return number of middle class agents
-    return len(mid_agents)
 
-
-def get_total_savings(model):
-    # list of amounts of all agents' savings
-    agent_savings = [a.savings for a in model.schedule.agents]
-    # return the sum of agents' savings
-    return np.sum(agent_savings)
-
-
-def get_total_wallets(model):
-    # list of amounts of all agents' wallets
-    agent_wallets = [a.wallet for a in model.schedule.agents]
-    # return the sum of all agents' wallets
-    return np.sum(agent_wallets)
-
-
-def get_total_money(model):
-    # sum of all agents' wallets
-    wallet_money = get_total_wallets(model)
-    # sum of all agents' savings
-    savings_money = get_total_savings(model)
-    # return sum of agents' wallets and savings for total money
-    return wallet_money + savings_money
-
-
-def get_total_loans(model):
-    # list of amounts of all agents' loans
-    agent_loans = [a.loans for a in model.schedule.agents]
-    # return sum of all agents' loans
-    return np.sum(agent_loans)
+# every collected row is appended here; copies are kept at the steps below
+STEP_DATA_FILE = "BankReservesModel_Step_Data_Single_Run.csv"
+STEP_DATA_CHECKPOINTS = (100, 500, 1000)
 
 
 class BankReservesModel(Model):
 
     # grid height
-    grid_h = 20
+    grid_h = GRID_HEIGHT
     # grid width
-    grid_w = 20
+    grid_w = GRID_WIDTH
+    # (name, dtype) of each column recorded by step(), see _stats_row()
+    columns = MODEL_COLUMNS
 
     """init parameters "init_people", "rich_threshold", and "reserve_percent"
-       are all UserSettableParameters"""
-    def __init__(self, height=grid_h, width=grid_w, init_people=2, rich_threshold=10,
-                 reserve_percent=50, run_time=1000):
+       are all UserSettableParameters; step_data_file=None turns off the
+       single run csv files.
+       collect_every sets how often statistics are recorded: the default of 10
+       is plenty for the plotted curves and keeps the data 10x smaller, set it
+       to 1 when step by step detail is needed"""
+    def __init__(self, height=grid_h, width=grid_w, init_people=INIT_PEOPLE_DEFAULT,
+                 rich_threshold=RICH_THRESHOLD_DEFAULT, reserve_percent=RESERVE_PERCENT_DEFAULT,
+                 run_time=RUN_TIME_DEFAULT, seed=None, step_data_file=STEP_DATA_FILE,
+                 collect_every=COLLECT_EVERY_DEFAULT):
         self.height = height
         self.width = width
         self.init_people = init_people
@@ -99,26 +85,28 @@ class BankReservesModel(Model):
         self.rich_threshold = rich_threshold
         self.reserve_percent = reserve_percent
         self.run_time = run_time  # Store run_time as an attribute
+        self.collect_every = collect_every
         
-        # see datacollector functions above
-        self.datacollector = DataCollector(model_reporters={
-                                           "Rich": get_num_rich_agents,
-                                           "Poor": get_num_poor_agents,
-                                           "Middle Class": get_num_mid_agents,
-                                           "Savings": get_total_savings,
-                                           "Wallets": get_total_wallets,
-                                           "Money": get_total_money,
-                                           "Loans": get_total_loans},
-                                           agent_reporters={
-                                           "Wealth": lambda x: x.wealth})
+        """one row of Stats per step, preallocated for the whole run - see
+           recorder.py"""
+        self.datacollector = StepRecorder(self.columns, self.run_time // self.collect_every + 1)
+        """stream rows to the step data file as they are collected, rather than
+           rebuilding and rewriting the whole table at every checkpoint; the
+           file is only opened once the first row is written"""
+        self.step_data_file = step_data_file
+        self._csv = None
+        self._csv_started = False
 
         # create a single bank for the model
         self.bank = Bank(1, self, self.reserve_percent)
 
+        """draw every person's starting cell in one call; a fixed seed makes the
+           placement reproducible"""
+        rng = np.random.default_rng(seed)
+        coords = rng.integers([0, 0], [self.width, self.height], size=(self.init_people, 2))
+
         # create people for the model according to number of people set by user
-        for i in range(self.init_people):
-            x = random.randrange(self.width)
-            y = random.randrange(self.height)
+        for i, (x, y) in enumerate(coords.tolist()):
             p = Person(i, (x, y), self, True, self.bank, self.rich_threshold)
             self.grid.place_agent(p, (x, y))
             self.schedule.add(p)
@@ -127,31 +115,85 @@ class BankReservesModel(Model):
         self.running = True
         self.current_step = 0
 
+    def _collect_stats(self):
+        """
+        Compute every model statistic in one compiled pass.
+
+        People keep savings, wallet and loans as plain attributes, which is
+        what their step() reads and writes many times per step; they are only
+        gathered into arrays here, once per collected step.
+        """
+        agents = self.schedule.agents
+        n = len(agents)
+        s = np.fromiter((a.savings for a in agents), dtype=np.float64, count=n)
+        w = np.fromiter((a.wallet for a in agents), dtype=np.float64, count=n)
+        l = np.fromiter((a.loans for a in agents), dtype=np.float64, count=n)
+        rich, poor, mid, savings, wallets, loans = aggregate(s, w, l, float(self.rich_threshold))
+        return Stats(rich, poor, mid, savings, wallets, savings + wallets, loans)
+
+    def _stats_row(self):
+        # the values recorded each step, in the order of self.columns
+        return self._collect_stats()
+
+    def _write_step_data(self, row):
+        """open the step data file with the first row, and again after close();
+           it is line buffered, so a model that is dropped without close()
+           (e.g. on a server reset) has no rows left to flush into the file
+           once the next model has started writing it"""
+        if self._csv is None:
+            if self._csv_started:
+                self._csv = open(self.step_data_file, "a", buffering=1)
+            else:
+                self._csv = open(self.step_data_file, "w", buffering=1)
+                self._csv.write("," + ",".join(name for name, _ in self.columns) + "\n")
+                self._csv_started = True
+        self._csv.write(f"{self.current_step}," + ",".join(map(str, row)) + "\n")
+
+    def close(self):
+        """
+        Flush and close the step data file.
+
+        Called when the run ends and when run_model() returns; stepping the
+        model again reopens the file and appends to it.
+        """
+        if self._csv is not None:
+            self._csv.close()
+            self._csv = None
+
     def step(self):
         # Only step if the model is still running
         if self.running:
-            # collect data
-            self.datacollector.collect(self)
+            # collect data on every collect_every-th step
+            if self.current_step % self.collect_every == 0:
+                row = self._stats_row()
+                if self.step_data_file is not None:
+                    self._write_step_data(row)
+                self.datacollector.collect(row)
             # tell all the agents in the model to run their step function
             self.schedule.step()
             self.current_step += 1
 
+            # if the step count is in the list then keep a copy of the data file so far
+            if (self.step_data_file is not None and self._csv_started
+                    and self.current_step in STEP_DATA_CHECKPOINTS):
+                shutil.copyfile(self.step_data_file,
+                                f"BankReservesModel_Step_Data_Single_Run{self.current_step}.csv")
+
             # Optional: stop the model after a certain number of steps
             if self.current_step >= self.run_time:
                 self.running = False
+                self.close()
 
-            # if the step count is in the list then create a data file of model state
-            if self.current_step in [100, 500, 1000]:
-                model_data = self.datacollector.get_model_vars_dataframe()
-                model_data.to_csv(f"BankReservesModel_Step_Data_Single_Run{self.current_step}.csv")
-
-    def run_model(self, run_time=1000):
+    def run_model(self, run_time=RUN_TIME_DEFAULT):
         """
         Run the model for a specified number of steps.
         
         Args:
             run_time (int): Number of steps to run the model. Defaults to 1000.
         """
-        for i in range(run_time):
-            print(f'Stepping {i}')
-            self.step()
+        try:
+            for i in range(run_time):
+                print(f'Stepping {i}')
+                self.step()
+        finally:
+            self.close()
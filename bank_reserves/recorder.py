@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+"""
+Lightweight replacement for mesa's DataCollector.
+
+The models only record a fixed set of model level statistics once per step,
+so instead of appending to Python lists the rows are written into a NumPy
+record array sized for the whole run. pandas is only involved when the data
+is read back out as a DataFrame.
+"""
+
+
+class StepRecorder:
+    '''
+    Records one row of model statistics per collect() call.
+
+    columns: sequence of (name, dtype) pairs, in the order the values are
+             passed to collect().
+    size: number of rows to preallocate, normally the model's run_time.
+          The buffer doubles in size if more rows than that are collected.
+    '''
+
+    __slots__ = ("buf", "rows")
+
+    def __init__(self, columns, size):
+        self.buf = np.empty(max(size, 1), dtype=list(columns))
+        # number of rows collected so far
+        self.rows = 0
+
+    def collect(self, row):
+        # grow the buffer if the model runs past its expected length
+        if self.rows == len(self.buf):
+            self.buf = np.concatenate((self.buf, np.empty_like(self.buf)))
+        self.buf[self.rows] = tuple(row)
+        self.rows += 1
+
+    @property
+    def model_vars(self):
+        # same shape as DataCollector.model_vars, read by mesa's ChartModule
+        data = self.buf[:self.rows]
+        return {name: data[name] for name in data.dtype.names}
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.buf[:self.rows])
+
+    # DataCollector compatible name, used by the CSV writers
+    get_model_vars_dataframe = to_dataframe
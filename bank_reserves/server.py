@@ -5,7 +5,7 @@ from mesa.visualization.ModularVisualization import ModularServer
 from mesa.visualization.modules import CanvasGrid, ChartModule
 from mesa.visualization.UserParam import UserSettableParameter
 from bank_reserves.agents import Person
-from bank_reserves.model import BankReservesModel
+from bank_reserves.model import BankReservesModel, GRID_HEIGHT, GRID_WIDTH, RUN_TIME_DEFAULT
 
 """
 Citation:
@@ -60,12 +60,14 @@ model_params = {
                                             description="Upper End of Random Initial Wallet Amount"),
     "reserve_percent": UserSettableParameter("slider", "Reserves", 50, 1, 100,
                                              description="Percent of deposits the bank has to hold in reserve"),
-    "run_time": UserSettableParameter("number", "Run Time", 1000, 10, 10000,
-                                      description="Number of steps to run the model")
+    "run_time": UserSettableParameter("number", "Run Time", RUN_TIME_DEFAULT, 10, 10000,
+                                      description="Number of steps to run the model"),
+    # the chart is redrawn every step, so record every step
+    "collect_every": 1
 }
 
 # set the portrayal function and size of the canvas for visualization
-canvas_element = CanvasGrid(person_portrayal, 20, 20, 500, 500)
+canvas_element = CanvasGrid(person_portrayal, GRID_WIDTH, GRID_HEIGHT, 500, 500)
 
 # map data to chart in the ChartModule
 chart_element = ChartModule([{"Label": "Rich", "Color": RICH_COLOR},